@@ -2,18 +2,25 @@
 import os
 import sys
 import json
+import orjson
 import logging
 import asyncio
+import collections
+import datetime
+import hashlib
+import itertools
 import re
 import time
-import io
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from sqlite3 import Error
 import sqlite3
 import fitz  # PyMuPDF
 import google.generativeai as genai
-from PIL import Image
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
-from thefuzz import fuzz
+from rapidfuzz import fuzz, process
 
 
 
@@ -30,7 +37,28 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 # --- Globals ---
 DB_NAME = "voter_data.db"
 MODEL_NAME = "gemini-1.5-flash"
-MAX_CONCURRENT_REQUESTS = 50
+MAX_CONCURRENT_REQUESTS = 50  # Gemini calls in flight across every PDF being processed
+MAX_CONCURRENT_PDFS = 4  # PDFs of one upload job processed at the same time
+RENDER_DOCUMENT_CACHE_SIZE = MAX_CONCURRENT_PDFS  # open PDFs kept per render worker, so interleaved PDFs don't evict each other
+# Header/footer pages hold dense small print; the voter grid reads fine at a lower DPI.
+RENDER_DPI_BY_PROMPT = {
+    "header_metadata": 300,
+    "footer_summary": 300,
+    "voter_list_page": 200,
+}
+JPEG_QUALITY = 85
+# Built once at import and bound to the model, so calls carry no per-request config construction.
+GENERATION_CONFIG = genai.types.GenerationConfig(max_output_tokens=8192)  # room for a full page of JSONL voters
+MODEL = genai.GenerativeModel(MODEL_NAME, generation_config=GENERATION_CONFIG)
+SKIPPED_PAGE_INDICES = frozenset({1})  # page 2 carries nothing we extract
+VOTER_INSERT_BATCH_SIZE = 500  # voter rows buffered before each executemany
+SECTION_MATCH_SCORE_CUTOFF = 60  # minimum partial_ratio for a page section name to match a header section
+RATE_LIMIT_BREAKER_THRESHOLD = 3  # consecutive 429s before every request pauses
+# Per-key quota for MODEL_NAME; keep these in line with the project's Gemini tier.
+GEMINI_REQUESTS_PER_MINUTE = 1000
+GEMINI_TOKENS_PER_MINUTE = 4_000_000
+IMAGE_TOKEN_ESTIMATE = 258  # Gemini 1.5 bills each image as a flat 258 input tokens
+GEMINI_CACHE_MAX_AGE_DAYS = 30  # cached Gemini answers older than this are pruned after each job
 
 # --- 3. Prompts and Mappings (Keep your existing prompts) ---
 # --- 3. Prompts and Mappings ---
@@ -97,7 +125,7 @@ Important Instructions:
 """ 
 
 VOTER_LIST_PAGE_PROMPT = """
-# PROMPT_VERSION: 2025-07-19_V3_JSONL - Voter List Page Prompt (Line-Delimited JSON)
+# PROMPT_VERSION: 2026-10-15_V4_JSONL - Voter List Page Prompt (Line-Delimited JSON)
 
 You are an expert at extracting structured information from voter list PDF images.
 Perform OCR on this image. Then, from the OCR'd text all individual voter objects.
@@ -115,7 +143,7 @@ First, identify the 'વિભાગ નામ' at the top of the page and extra
 
 For each 'voter' object (one per line):
 - 'type': "voter"
-- 'json_schema_version': "2025-07-19_V3_JSONL"
+- 'json_schema_version': "2026-10-15_V4_JSONL"
 - 'SL_NO': Extract the serial number shown next to the voter's details box (e.g., "1").
 - 'VOTER_NAME': Locate the 'મતદાનું નામ:' field. Extract **ALL text** that follows 'મતદાનું નામ:' up until the next distinct field label (e.g., 'પિતાનું નામ:', 'પતિનું નામ:', or 'ઘર નંબર:'). **Combine all words and parts, including any surnames appearing on the same or subsequent lines, into a single, complete full name for the voter.** (e.g., "અવધકુમાર શેરવાળી", "મોહમદમુસા હલદર", "મોહમદ શભર હલદર").
 - 'RELATIVE_NAME': Locate the 'પિતાનું નામ:' or 'પતિનું નામ:' field. Extract **ALL text** that follows this relation label up until the next distinct field label (e.g., 'ઘર નંબર:', 'ઉમર :'). **Combine all words and parts, including any surnames appearing on the same or subsequent lines, into a single, complete full name for the father/husband/mother.** (e.g., "હિરાલાલ શેરવાળી", "મોહમદઅલીમ હલદર"). If no relation name is found, use an empty string.
@@ -124,7 +152,6 @@ For each 'voter' object (one per line):
 - 'GENDER': Extract the gender (e.g., 'પુરૂષ').
 - 'IDCARD_NO': Extract the Voter ID (e.g: "SRV2111425","XDA3171667","GJ/21/141/006010",etc.....).**Extracting this field is very important,It should be there in the voter object otherwise the object is of no use**
 - 'RLN_TYPE': "Identify if RELATIVE_NAME field is 'પતિનું નામ:'= H, 'પિતાનું નામ:'= F, 'માતાનું નામ'= M, 'અન્ય'= O"
-- 'ALL_TXT': Extract all raw text content within this specific voter's detail box.
 - 'BOX_NO_ON_PAGE': The sequential number of the voter on this specific page (1-30).
 - 'STATUSTYPE': **Analyze the voter's box. If a semi-transparent "DELETED" stamp is visible over the text, set this to "D".** If a "#" symbol appears before the SL_NO, set this to "M". Otherwise, set this to "N".
 - 'PAGE_SECTION_NAME': "Use the section name you identified at the start of the process as the value for this field. Use the exact same value for every voter object on this page."
@@ -212,54 +239,228 @@ PROMPT_MAPPING = {
 }
 
 # --- 4. Helper & Processing Functions ---
+# Keyed on the first three code points, which is how the OCR'd values actually start.
+_GENDER_PREFIX_MAP = {"પુર": "પુરુષ", "સ્ત": "સ્ત્રી"}
+
 def normalize_gender(gender_text):
     if gender_text:
+        normalized = _GENDER_PREFIX_MAP.get(gender_text[:3])
+        if normalized: return normalized
+        # Slow path for values with a label or stray text in front.
         if "પુર" in gender_text: return "પુરુષ"
         if "સ્ત્ર" in gender_text: return "સ્ત્રી"
     return gender_text
 
-def convert_pdf_page_to_image(pdf_path, page_number):
+_worker_documents = collections.OrderedDict()  # (path, mtime_ns, size) -> open document, least recently used first
+
+def _get_worker_document(pdf_path):
+    """
+    Opens `pdf_path` once per render worker and reuses it for every later page.
+    The RENDER_DOCUMENT_CACHE_SIZE most recently used PDFs stay open, so the
+    pages of concurrently processed PDFs can interleave on the same worker.
+    """
+    stat = os.stat(pdf_path)
+    key = (pdf_path, stat.st_mtime_ns, stat.st_size)
+    doc = _worker_documents.get(key)
+    if doc is not None:
+        _worker_documents.move_to_end(key)
+        return doc
+    # Open from memory so no file handle outlives the uploaded file.
+    with open(pdf_path, "rb") as f:
+        doc = _worker_documents[key] = fitz.open(stream=f.read(), filetype="pdf")
+    while len(_worker_documents) > RENDER_DOCUMENT_CACHE_SIZE:
+        _, evicted = _worker_documents.popitem(last=False)
+        evicted.close()
+    return doc
+
+def render_page(doc, page_number, dpi, split=False):
+    """
+    Renders a page and returns a list of JPEG images: the whole page, or its
+    top and bottom halves when `split` is set. Halves are cut straight from a
+    single display list, so the page content is interpreted only once.
+    """
+    page = doc.load_page(page_number)
+    rect = page.rect
+    if split:
+        midpoint = rect.y0 + rect.height / 2
+        clips = [fitz.Rect(rect.x0, rect.y0, rect.x1, midpoint), fitz.Rect(rect.x0, midpoint, rect.x1, rect.y1)]
+    else:
+        clips = [rect]
+    display_list = page.get_displaylist()
+    zoom = dpi / 72
+    matrix = fitz.Matrix(zoom, zoom)
+    return [display_list.get_pixmap(matrix=matrix, clip=clip).tobytes("jpeg", jpg_quality=JPEG_QUALITY) for clip in clips]
+
+def convert_pdf_page_to_image(pdf_path, page_number, dpi, split=False):
     try:
-        doc = fitz.open(pdf_path)
+        doc = _get_worker_document(pdf_path)
         if page_number >= len(doc): return None
-        page = doc.load_page(page_number)
-        pix = page.get_pixmap(dpi=300)
-        image = Image.open(io.BytesIO(pix.tobytes("png")))
-        doc.close()
-        return image
+        return render_page(doc, page_number, dpi, split)
     except Exception as e:
         logging.exception(f"Error converting PDF page {page_number} for {pdf_path}.")
         return None
 
-async def _do_nothing():
-    return None
-
-async def process_image_with_gemini_async(semaphore, image, prompt, page_identifier):
-    model = genai.GenerativeModel(MODEL_NAME)
+_render_pool = None
+
+def get_render_pool():
+    """Returns the shared process pool used for CPU-bound page rasterization."""
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _render_pool
+
+def reset_render_pool(broken_pool):
+    """Drops `broken_pool` after a worker crash (e.g. MuPDF on a malformed PDF) so the next render starts a fresh pool."""
+    global _render_pool
+    if _render_pool is broken_pool:
+        _render_pool = None
+        broken_pool.shutdown(wait=False)
+
+def submit_render(loop, *args):
+    """Queues convert_pdf_page_to_image on the render pool, replacing the pool once if it is broken."""
+    render_pool = get_render_pool()
+    try:
+        return render_pool, loop.run_in_executor(render_pool, convert_pdf_page_to_image, *args)
+    except BrokenProcessPool:
+        reset_render_pool(render_pool)
+        render_pool = get_render_pool()
+        return render_pool, loop.run_in_executor(render_pool, convert_pdf_page_to_image, *args)
+
+class AsyncRateLimiter:
+    """Token bucket allowing `rate` units per `period` seconds, refilled continuously."""
+    def __init__(self, rate, period=60.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = None
+
+    async def acquire(self, amount=1):
+        """Waits until `amount` units are available, then takes them."""
+        amount = min(amount, self.rate)
+        if self._lock is None:
+            # Created lazily so the lock belongs to the background loop, not the importing thread.
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.period)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) * self.period / self.rate)
+
+    def adjust(self, amount):
+        """Credits `amount` units back to the bucket (or debits them when negative) once the real cost is known."""
+        self._tokens = min(self.rate, self._tokens + amount)
+
+_gemini_semaphore = None
+
+def get_gemini_semaphore():
+    """Returns the semaphore shared by every PDF in flight, so MAX_CONCURRENT_REQUESTS caps the whole process."""
+    global _gemini_semaphore
+    if _gemini_semaphore is None:
+        # Created lazily so it belongs to the background loop, not the importing thread.
+        _gemini_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    return _gemini_semaphore
+
+REQUEST_LIMITER = AsyncRateLimiter(GEMINI_REQUESTS_PER_MINUTE)
+TOKEN_LIMITER = AsyncRateLimiter(GEMINI_TOKENS_PER_MINUTE)
+
+def estimate_request_tokens(prompt):
+    """Rough input-token cost of one prompt + image request (~4 characters per token)."""
+    return len(prompt) // 4 + IMAGE_TOKEN_ESTIMATE
+
+_consecutive_rate_limits = 0
+_rate_limited_until = 0.0
+
+def get_retry_delay(error):
+    """Returns the server-suggested retry delay in seconds for a 429 error, or None."""
+    delay = getattr(error, "retry_delay", None)
+    if delay is None:
+        for detail in getattr(error, "details", None) or []:
+            delay = getattr(detail, "retry_delay", None)
+            if delay is not None:
+                break
+    if delay is None:
+        return None
+    if hasattr(delay, "total_seconds"):
+        return delay.total_seconds()
+    return getattr(delay, "seconds", 0) + getattr(delay, "nanos", 0) / 1e9
+
+def _record_rate_limit(delay):
+    """Opens the circuit breaker once too many 429s arrive back to back."""
+    global _consecutive_rate_limits, _rate_limited_until
+    _consecutive_rate_limits += 1
+    if _consecutive_rate_limits >= RATE_LIMIT_BREAKER_THRESHOLD:
+        pause = delay if delay is not None else 2 ** min(_consecutive_rate_limits, 6)
+        _rate_limited_until = max(_rate_limited_until, time.monotonic() + pause)
+
+async def _wait_for_rate_limit_window():
+    remaining = _rate_limited_until - time.monotonic()
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+
+async def process_image_with_gemini_async(semaphore, image_bytes, prompt, page_identifier, db_connection=None):
+    global _consecutive_rate_limits
     retries = 5
+    # Identical image + prompt pairs (e.g. a corrected PDF re-uploaded) are answered from gemini_cache.
+    cache_key = gemini_cache_key(image_bytes, prompt) if db_connection is not None else None
+    if cache_key is not None:
+        cached_text = await run_db_read(get_cached_response, cache_key)
+        if cached_text:
+            logging.info(f"Cache hit for page {page_identifier}; skipping the API call.")
+            return cached_text
+    estimated_tokens = estimate_request_tokens(prompt)
     async with semaphore:
         for attempt in range(retries):
+            await _wait_for_rate_limit_window()
+            # Stay inside the RPM/TPM quota up front instead of discovering it through 429s.
+            await REQUEST_LIMITER.acquire()
+            await TOKEN_LIMITER.acquire(estimated_tokens)
             try:
-                response = await model.generate_content_async([prompt, image])
+                response = await MODEL.generate_content_async([prompt, {"mime_type": "image/jpeg", "data": image_bytes}])
+                _consecutive_rate_limits = 0
+                # Settle the reservation against the billed input tokens so estimate errors don't drift the TPM budget.
+                actual_tokens = getattr(getattr(response, "usage_metadata", None), "prompt_token_count", None)
+                if actual_tokens:
+                    TOKEN_LIMITER.adjust(estimated_tokens - actual_tokens)
                 if response and hasattr(response, "text") and response.text:
+                    # Only answers that parse cleanly are cached, so a truncated or malformed one is asked again on re-upload.
+                    if cache_key is not None and is_cacheable_response(response.text):
+                        await run_db_write(store_cached_response, db_connection, cache_key, response.text)
                     return response.text
                 logging.warning(f"Empty response for page {page_identifier}, attempt {attempt+1}")
                 if attempt < retries - 1: await asyncio.sleep(2**attempt)
+            except (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests) as e:
+                delay = get_retry_delay(e)
+                _record_rate_limit(delay)
+                TOKEN_LIMITER.adjust(estimated_tokens)  # a rejected request consumed no tokens
+                logging.warning(f"Rate limited on page {page_identifier}, attempt {attempt+1}; retry delay: {delay}")
+                if attempt < retries - 1: await asyncio.sleep(delay if delay is not None else 2**attempt + random.random())
+            except google_exceptions.ClientError as e:
+                # Any other 4xx (bad request, auth, not found) will not succeed on retry.
+                logging.error(f"Non-retryable API error on page {page_identifier}: {e}")
+                return None
             except Exception as e:
                 logging.warning(f"API Error on page {page_identifier}, attempt {attempt+1}: {e}")
-                if attempt < retries - 1: await asyncio.sleep(min(60, 2**attempt))
+                if attempt < retries - 1: await asyncio.sleep(min(60, 2**attempt) + random.random())
     logging.error(f"Failed to get response for page {page_identifier} after {retries} retries.")
     return None
 
-async def process_voter_page_in_chunks_async(semaphore, page_image, prompt, page_index):
-    logging.info(f"Splitting voter page {page_index + 1} for chunked processing.")
-    width, height = page_image.size
-    midpoint = height // 2
-    top_half = page_image.crop((0, 0, width, midpoint))
-    bottom_half = page_image.crop((0, midpoint, width, height))
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+def strip_code_fences(text):
+    """Removes a leading ```/```json fence and a trailing ``` fence in one pass."""
+    return _FENCE_RE.sub("", text)
+
+async def process_voter_page_in_chunks_async(semaphore, page_halves, prompt, page_index, db_connection=None):
+    logging.info(f"Sending voter page {page_index + 1} as two chunks.")
+    top_half, bottom_half = page_halves
     chunk_tasks = [
-        process_image_with_gemini_async(semaphore, top_half, prompt, f"{page_index + 1}-Top"),
-        process_image_with_gemini_async(semaphore, bottom_half, prompt, f"{page_index + 1}-Bottom")
+        process_image_with_gemini_async(semaphore, top_half, prompt, f"{page_index + 1}-Top", db_connection),
+        process_image_with_gemini_async(semaphore, bottom_half, prompt, f"{page_index + 1}-Bottom", db_connection)
     ]
     chunk_results = await asyncio.gather(*chunk_tasks, return_exceptions=True)
     combined_response_text = ""
@@ -267,47 +468,201 @@ async def process_voter_page_in_chunks_async(semaphore, page_image, prompt, page
         if isinstance(result, Exception) or not result:
             logging.error(f"Failed to get a valid result for page {page_index + 1}, part {i+1}. Error: {result}")
             continue
-        cleaned_chunk = result.strip().removeprefix("```json").removesuffix("```").strip()
+        cleaned_chunk = strip_code_fences(result)
         combined_response_text += cleaned_chunk + "\n"
     return combined_response_text.strip()
 
+async def process_page_images_async(semaphore, page_images, prompt, page_index, db_connection=None):
+    """Sends a rendered page (whole, or as top/bottom halves) to Gemini."""
+    if not page_images:
+        return None
+    if len(page_images) > 1:
+        return await process_voter_page_in_chunks_async(semaphore, page_images, prompt, page_index, db_connection)
+    return await process_image_with_gemini_async(semaphore, page_images[0], prompt, page_index + 1, db_connection)
+
+async def render_pages_async(pdf_path, page_indices, render_dpis, is_voter_page, render_queue, page_results):
+    """
+    Producer stage: renders pages in order on the process pool, keeping one
+    render per core in flight, and feeds (page_index, images) into the bounded
+    `render_queue` so rendering never runs far ahead of the Gemini workers.
+    A page that fails to render is queued as None. Pages never queued (the
+    producer died or was cancelled) have their `page_results` future failed,
+    so nobody waits on them forever.
+    """
+    loop = asyncio.get_running_loop()
+    in_flight = collections.deque()
+    queued = set()
+
+    async def put_oldest():
+        page_index, render_pool, render_future = in_flight.popleft()
+        try:
+            page_images = await render_future
+        except BrokenProcessPool as e:
+            logging.error(f"Render worker crashed on or next to page {page_index + 1}: {e}")
+            reset_render_pool(render_pool)
+            page_images = None
+        except Exception as e:
+            logging.error(f"Render failed for page {page_index + 1}: {e}")
+            page_images = None
+        await render_queue.put((page_index, page_images))
+        queued.add(page_index)
+
+    try:
+        for i in page_indices:
+            try:
+                render_pool, render_future = submit_render(loop, pdf_path, i, render_dpis[i], is_voter_page[i])
+            except Exception as e:
+                render_pool, render_future = None, loop.create_future()
+                render_future.set_exception(e)
+            in_flight.append((i, render_pool, render_future))
+            if len(in_flight) >= (os.cpu_count() or 1):
+                await put_oldest()
+        while in_flight:
+            await put_oldest()
+    finally:
+        for i in page_indices:
+            future = None if i in queued else page_results.pop(i, None)
+            if future is not None and not future.done():
+                future.set_exception(RuntimeError(f"Page {i + 1} was never rendered."))
+
+async def gemini_worker_async(semaphore, render_queue, prompts, page_results, db_connection=None):
+    """
+    Consumer stage: takes rendered pages off the queue and resolves each page's result future.
+    Resolved futures are popped from page_results, so only the awaiting caller keeps them alive.
+    """
+    while True:
+        page_index, page_images = await render_queue.get()
+        try:
+            result = await process_page_images_async(semaphore, page_images, prompts[page_index], page_index, db_connection)
+            future = page_results.pop(page_index)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            future = page_results.pop(page_index, None)
+            if future is not None and not future.done():
+                future.set_exception(e)
+        finally:
+            render_queue.task_done()
+
+_JSON_OBJ_RE = re.compile(r"\{[\s\S]*\}")
+_WHITESPACE_RE = re.compile(r"\s*")
+_JSON_DECODER = json.JSONDecoder()
+
 def parse_gemini_response(text_response, prompt_type, page_index):
     if not text_response:
         logging.warning(f"Cannot parse empty response for page {page_index+1}")
         return None
     if prompt_type in ["header_metadata", "footer_summary"]:
-        cleaned_response = text_response.strip().removeprefix("```json").removesuffix("```").strip()
+        cleaned_response = strip_code_fences(text_response)
         try:
-            match = re.search(r"\{[\s\S]*\}", cleaned_response)
+            match = _JSON_OBJ_RE.search(cleaned_response)
             if match:
-                return json.loads(match.group(0))
+                return orjson.loads(match.group(0))
             logging.error(f"No valid JSON object found for page {page_index+1}")
             return None
-        except json.JSONDecodeError as e:
+        except orjson.JSONDecodeError as e:
             logging.error(f"JSON decode error for page {page_index+1}: {e}\nResponse:\n{cleaned_response}")
             return None
     else:  # Voter list page (JSONL)
         parsed_data = []
-        for i, line in enumerate(text_response.strip().split("\n")):
-            if line.strip():
-                try:
-                    parsed_data.append(json.loads(line.strip()))
-                except json.JSONDecodeError:
-                    logging.warning(f"Page {page_index+1}, Line {i+1}: Could not parse JSONL. RAW LINE: '{line.strip()}'")
+        for value, raw_line in iter_jsonl_values(text_response):
+            if raw_line is not None:
+                logging.warning(f"Page {page_index+1}: Could not parse JSONL. RAW LINE: '{raw_line}'")
+                continue
+            # Only objects are voter records; stray scalars (e.g. "2 voters on this half") are dropped.
+            for record in value if isinstance(value, list) else [value]:
+                if isinstance(record, dict):
+                    parsed_data.append(record)
+                else:
+                    logging.warning(f"Page {page_index+1}: Ignoring non-object JSON value: {record!r}")
         return parsed_data
 
+def iter_jsonl_values(text_response):
+    """
+    Decodes JSON values straight out of the buffer, which also copes with several
+    values on one line. Yields (value, None), or (None, raw_line) for a line that doesn't parse.
+    """
+    idx, end = 0, len(text_response)
+    while True:
+        idx = _WHITESPACE_RE.match(text_response, idx).end()
+        if idx >= end:
+            return
+        try:
+            value, idx = _JSON_DECODER.raw_decode(text_response, idx)
+        except json.JSONDecodeError:
+            line_end = text_response.find("\n", idx)
+            line_end = end if line_end == -1 else line_end
+            yield None, text_response[idx:line_end]
+            idx = line_end
+            continue
+        yield value, None
+
+def is_cacheable_response(text_response):
+    """
+    True when a response decodes cleanly into JSON objects and nothing else. That holds
+    for a complete header/footer object and for well-formed voter JSONL alike, while a
+    truncated or malformed answer fails it and is asked again on the next upload.
+    """
+    has_objects = False
+    for value, raw_line in iter_jsonl_values(strip_code_fences(text_response)):
+        if raw_line is not None:
+            return False
+        for record in value if isinstance(value, list) else [value]:
+            if not isinstance(record, dict):
+                return False
+            has_objects = True
+    return has_objects
+
 # --- 5. Database Schema and Functions ---
 TABLES = {
     'pdfs': "CREATE TABLE IF NOT EXISTS `pdfs` (`id` INTEGER PRIMARY KEY, `file_name` TEXT NOT NULL UNIQUE, `assembly_constituency` TEXT, `part_number` INTEGER, `publication_date` TEXT, `total_voters_count` INTEGER, `processed_at` TEXT DEFAULT CURRENT_TIMESTAMP)",
     'sections': "CREATE TABLE IF NOT EXISTS `sections` (`id` INTEGER PRIMARY KEY, `pdf_id` INTEGER NOT NULL, `section_name` TEXT, FOREIGN KEY (`pdf_id`) REFERENCES `pdfs`(`id`) ON DELETE CASCADE)",
-    'voters': "CREATE TABLE IF NOT EXISTS `voters` (`id` INTEGER PRIMARY KEY, `section_id` INTEGER NOT NULL, `idc_no` TEXT NOT NULL UNIQUE, `VOTER_NAME` TEXT, `RELATIVE_NAME` TEXT, `rln_type` TEXT, `house_no` TEXT, `age` INTEGER, `gender` TEXT, `sl_no_in_pdf` INTEGER, `box_no_on_page` INTEGER, `page_no` INTEGER,`all_text` TEXT, `statustype` TEXT, FOREIGN KEY (`section_id`) REFERENCES `sections`(`id`) ON DELETE CASCADE)",
-    'summary_stats': "CREATE TABLE IF NOT EXISTS `summary_stats` (`id` INTEGER PRIMARY KEY, `pdf_id` INTEGER NOT NULL, `description` TEXT, `male_count` INTEGER, `female_count` INTEGER, `other_gender_count` INTEGER, `total_count` INTEGER, FOREIGN KEY (`pdf_id`) REFERENCES `pdfs`(`id`) ON DELETE CASCADE)"
+    'voters': "CREATE TABLE IF NOT EXISTS `voters` (`id` INTEGER PRIMARY KEY, `section_id` INTEGER NOT NULL, `idc_no` TEXT NOT NULL UNIQUE, `VOTER_NAME` TEXT, `RELATIVE_NAME` TEXT, `rln_type` TEXT, `house_no` TEXT, `age` INTEGER, `gender` TEXT, `sl_no_in_pdf` INTEGER, `box_no_on_page` INTEGER, `page_no` INTEGER, `statustype` TEXT, `age_group` TEXT, FOREIGN KEY (`section_id`) REFERENCES `sections`(`id`) ON DELETE CASCADE)",
+    'summary_stats': "CREATE TABLE IF NOT EXISTS `summary_stats` (`id` INTEGER PRIMARY KEY, `pdf_id` INTEGER NOT NULL, `description` TEXT, `male_count` INTEGER, `female_count` INTEGER, `other_gender_count` INTEGER, `total_count` INTEGER, FOREIGN KEY (`pdf_id`) REFERENCES `pdfs`(`id`) ON DELETE CASCADE)",
+    'gemini_cache': "CREATE TABLE IF NOT EXISTS `gemini_cache` (`cache_key` BLOB PRIMARY KEY, `response` TEXT NOT NULL, `created_at` TEXT DEFAULT CURRENT_TIMESTAMP) WITHOUT ROWID",
+    'jobs': "CREATE TABLE IF NOT EXISTS `jobs` (`id` TEXT PRIMARY KEY, `status` TEXT NOT NULL, `message` TEXT, `updated_at` REAL) WITHOUT ROWID",
+    'data_version': "CREATE TABLE IF NOT EXISTS `data_version` (`id` INTEGER PRIMARY KEY CHECK (`id` = 1), `version` INTEGER NOT NULL)"
 }
 
+# Kept as one shared string so every batch hits sqlite3's per-connection statement cache.
+VOTER_INSERT_ROW = "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+VOTER_INSERT_SQL = "INSERT OR IGNORE INTO voters (section_id, idc_no, VOTER_NAME, RELATIVE_NAME, rln_type, house_no, age, gender, sl_no_in_pdf, box_no_on_page, page_no, statustype, age_group) VALUES " + VOTER_INSERT_ROW
+# Multi-row form of the same insert, sized to stay under SQLite's conservative 999 bound-parameter limit.
+VOTER_ROWS_PER_STATEMENT = 999 // 13
+VOTER_MULTI_INSERT_SQL = VOTER_INSERT_SQL + (", " + VOTER_INSERT_ROW) * (VOTER_ROWS_PER_STATEMENT - 1)
+
+# Backfills rows stored before the column existed through the same age_group() the insert path uses.
+AGE_GROUP_BACKFILL_SQL = "UPDATE voters SET age_group = age_group(age) WHERE age_group IS NULL AND age_group(age) IS NOT NULL"
+
+# Inserts only ever raise MAX(id), but deletes let SQLite reuse rowids, so the webapp's ETag
+# also carries data_version.version, bumped on every PDF delete and on an age_group backfill.
+BUMP_DATA_VERSION_SQL = "UPDATE data_version SET version = version + 1"
+TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS `trg_pdfs_delete_data_version` AFTER DELETE ON `pdfs` BEGIN UPDATE data_version SET version = version + 1; END",
+]
+
+INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS `idx_sections_pdf_name` ON `sections` (`pdf_id`, `section_name`)",
+    # Covering indexes for the dashboard's per-section GROUP BY queries; both also serve plain section_id lookups.
+    "CREATE INDEX IF NOT EXISTS `idx_voters_section_age_group` ON `voters` (`section_id`, `age_group`)",
+    "CREATE INDEX IF NOT EXISTS `idx_voters_section_gender` ON `voters` (`section_id`, `gender`)",
+]
+
 def create_connection(db_file):
+    """
+    Opens a SQLite connection tuned for the bulk-insert workload.
+    WAL mode keeps `-wal`/`-shm` files next to the database, so the DB
+    directory must be writable by the app. The pipeline hands the connection
+    to the DB writer thread, hence check_same_thread=False.
+    """
     try:
-        conn = sqlite3.connect(db_file)
+        conn = sqlite3.connect(db_file, check_same_thread=False)
         conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.execute("PRAGMA temp_store = MEMORY;")
+        conn.execute("PRAGMA cache_size = -65536;")  # 64 MiB
+        conn.execute("PRAGMA mmap_size = 268435456;")  # 256 MiB
         logging.info(f"Connected to SQLite: {db_file}")
         return conn
     except Error as e:
@@ -319,12 +674,92 @@ def create_tables(conn):
         with conn:
             for ddl in TABLES.values():
                 conn.execute(ddl)
+            conn.execute("INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)")
+            migrate_voters_age_group(conn)
+            for ddl in INDEXES + TRIGGERS:
+                conn.execute(ddl)
         logging.info("Database tables verified successfully.")
     except Error as e:
         logging.error(f"Failed to create tables: {e}")
-def insert_pdf_data(conn, pdf_data, file_name):
+
+def migrate_voters_age_group(conn):
+    """
+    Adds and backfills voters.age_group on databases created before the column existed.
+    Every step is idempotent and runs on each startup: ALTER TABLE commits on its own,
+    so a backfill lost to a later failure or a crash is simply redone next time.
     """
-    Inserts PDF metadata and detailed summary statistics into the database.
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(voters)")}
+    if "age_group" not in columns:
+        logging.info("Adding age_group column to voters.")
+        conn.execute("ALTER TABLE voters ADD COLUMN age_group TEXT")
+    conn.create_function("age_group", 1, age_group, deterministic=True)
+    backfilled = conn.execute(AGE_GROUP_BACKFILL_SQL).rowcount
+    if backfilled:
+        logging.info(f"Backfilled age_group for {backfilled} existing voters.")
+        conn.execute(BUMP_DATA_VERSION_SQL)  # the charts change without any new rowid
+    # Superseded by idx_voters_section_age_group / idx_voters_section_gender.
+    conn.execute("DROP INDEX IF EXISTS idx_voters_section")
+
+def age_group(age):
+    """
+    Buckets an age into the dashboard's groups (18-29 ... 60+), or None if it isn't a number.
+    int() also reads Gujarati digits, so OCR'd ages like '૪૭' (stored as TEXT) are bucketed too.
+    """
+    try:
+        age = int(age)
+    except (TypeError, ValueError):
+        return None
+    if 18 <= age <= 29: return "18-29"
+    if 30 <= age <= 39: return "30-39"
+    if 40 <= age <= 49: return "40-49"
+    if 50 <= age <= 59: return "50-59"
+    return "60+"
+
+_DATE_RE = re.compile(r"(\d{1,2})[-/](\d{1,2})[-/](\d{4})")
+
+def parse_publication_date(date_str):
+    """Converts a DD-MM-YYYY (or DD/MM/YYYY) date to YYYY-MM-DD, or returns None."""
+    match = _DATE_RE.fullmatch(str(date_str).strip())
+    if not match:
+        return None
+    try:
+        # date() rejects impossible days such as 31-02 or 31-04, as strptime did.
+        return datetime.date(int(match[3]), int(match[2]), int(match[1])).isoformat()
+    except ValueError:
+        return None
+
+# A single thread runs every DB call of the pipeline, so commits don't stall the
+# event loop and a connection is never used from two threads at once.
+DB_WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-writer")
+
+async def run_db_write(func, *args):
+    """Runs a blocking DB function on the writer thread and awaits its result."""
+    return await asyncio.get_running_loop().run_in_executor(DB_WRITE_EXECUTOR, func, *args)
+
+# Gemini cache lookups get their own thread and connection to DB_NAME: WAL lets them read
+# alongside the writer instead of queueing behind voter batches and PRAGMA optimize.
+DB_READ_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-reader")
+_read_connection = None
+
+async def run_db_read(func, *args):
+    """Runs a blocking DB read on the reader thread and awaits its result."""
+    return await asyncio.get_running_loop().run_in_executor(DB_READ_EXECUTOR, func, *args)
+
+def get_read_connection():
+    """Returns the reader thread's connection, opened on first use."""
+    global _read_connection
+    if _read_connection is None:
+        _read_connection = create_connection(DB_NAME)
+    return _read_connection
+
+def pdf_exists(conn, file_name):
+    cursor = conn.execute("SELECT id FROM pdfs WHERE file_name = ?", (file_name,))
+    return cursor.fetchone() is not None
+
+def insert_pdf_data(conn, header, file_name):
+    """
+    Inserts the PDF metadata row from the header page into the database.
+    The footer's summary statistics are added later by insert_summary_data.
     This version is heavily instrumented with print statements for debugging.
     """
     print(f"\n--- [START] Processing insert_pdf_data for: {file_name} ---")
@@ -333,24 +768,10 @@ def insert_pdf_data(conn, pdf_data, file_name):
         with conn:
             cursor = conn.cursor()
             
-            print(f"[DB] Checking if PDF '{file_name}' already exists in the 'pdfs' table.")
-            cursor.execute("SELECT id FROM pdfs WHERE file_name = ?", (file_name,))
-            existing_pdf = cursor.fetchone()
-
-            if existing_pdf:
-                print(f"[WARN] PDF '{file_name}' already exists with ID: {existing_pdf[0]}. Skipping insertion.")
-                logging.warning(f"PDF '{file_name}' already exists. Skipping.")
-                return None
-            
-            print("[INFO] PDF does not exist in DB. Proceeding with data extraction.")
-            
-            header = pdf_data.get('header_metadata', {})
-            footer = pdf_data.get('footer_summary', {})
+            header = header or {}
 
             print("\n[DATA] Header data received:")
             print(json.dumps(header, indent=2, ensure_ascii=False))
-            print("\n[DATA] Footer data received:")
-            print(json.dumps(footer, indent=2, ensure_ascii=False))
             print("-" * 20)
 
             assembly_const = header.get("assembly_constituency_number_name_estimated", "")
@@ -358,60 +779,27 @@ def insert_pdf_data(conn, pdf_data, file_name):
             pub_date_str = header.get("publication_date", "")
             print(f"[EXTRACT] Assembly: '{assembly_const}', Part: '{part_num}', Pub Date String: '{pub_date_str}'")
 
-            pub_date = None
-            if pub_date_str:
-                try:
-                    pub_date = time.strftime('%Y-%m-%d', time.strptime(pub_date_str, '%d-%m-%Y'))
-                    print(f"[INFO] Successfully parsed publication date to: {pub_date}")
-                except ValueError:
-                    print(f"[WARN] Could not parse date '{pub_date_str}'.")
-                    logging.warning(f"Could not parse date '{pub_date_str}'.")
-
-            total_voters = None
-            print("[INFO] Attempting to extract total voter count from footer.")
-            if footer and footer.get("voter_summary", {}).get("rows"):
-                print("[INFO] Found 'voter_summary' with 'rows' in footer data.")
-                final_row = footer["voter_summary"]["rows"][-1]
-                print(f"[DATA] Final row for total count check: {final_row}")
-
-                if "આ સુધારણા પછી" in final_row.get("description", ""):
-                    total_voters = final_row.get("total_count")
-                    print(f"[EXTRACT] Successfully extracted total_voters: {total_voters}")
-                else:
-                    print("[WARN] Final total description 'આ સુધારણા પછી' not found in the last row.")
-            else:
-                print("[WARN] 'voter_summary' or 'rows' key not found in footer data.")
+            pub_date = parse_publication_date(pub_date_str) if pub_date_str else None
+            if pub_date:
+                print(f"[INFO] Successfully parsed publication date to: {pub_date}")
+            elif pub_date_str:
+                print(f"[WARN] Could not parse date '{pub_date_str}'.")
+                logging.warning(f"Could not parse date '{pub_date_str}'.")
 
-            values = (file_name, assembly_const, part_num, pub_date, total_voters)
+            values = (file_name, assembly_const, part_num, pub_date)
             print(f"\n[DB] Preparing to INSERT into 'pdfs' table with values: {values}")
-            cursor.execute("INSERT INTO pdfs (file_name, assembly_constituency, part_number, publication_date, total_voters_count) VALUES (?, ?, ?, ?, ?)", values)
-            
-            pdf_id = cursor.lastrowid
-            print(f"[DB] Successfully INSERTED record into 'pdfs' table. New pdf_id is: {pdf_id}")
-            logging.info(f"Inserted PDF '{file_name}' with ID: {pdf_id}")
+            # ON CONFLICT ... RETURNING (SQLite 3.35+) does the existence check and the insert in one statement.
+            cursor.execute("INSERT INTO pdfs (file_name, assembly_constituency, part_number, publication_date) VALUES (?, ?, ?, ?) ON CONFLICT(file_name) DO NOTHING RETURNING id", values)
+            inserted = cursor.fetchone()
 
-            print("\n[INFO] Attempting to insert detailed statistics into 'summary_stats' table.")
-            if footer and footer.get("voter_summary", {}).get("rows"):
-                rows_to_process = footer["voter_summary"]["rows"]
-                print(f"[INFO] Found {len(rows_to_process)} rows to insert into 'summary_stats'.")
-                
-                for i, row in enumerate(rows_to_process):
-                    print(f"\n  [LOOP {i+1}] Processing row: {row}")
-                    stat_values = (
-                        pdf_id,
-                        row.get('description'),
-                        row.get('male_count'),
-                        row.get('female_count'),
-                        row.get('other_gender_count'),
-                        row.get('total_count')
-                    )
-                    print(f"  [LOOP {i+1}] Preparing to INSERT into 'summary_stats' with values: {stat_values}")
-                    cursor.execute("INSERT INTO summary_stats (pdf_id, description, male_count, female_count, other_gender_count, total_count) VALUES (?, ?, ?, ?, ?, ?)", stat_values)
-                    print(f"  [LOOP {i+1}] Successfully INSERTED row for '{row.get('description')}'.")
-            else:
-                print("[WARN] No rows found to insert into 'summary_stats'.")
+            if inserted is None:
+                print(f"[WARN] PDF '{file_name}' already exists in the 'pdfs' table. Skipping insertion.")
+                logging.warning(f"PDF '{file_name}' already exists. Skipping.")
+                return None
 
-            print(f"\n[SUCCESS] All database operations for pdf_id {pdf_id} are complete. Returning pdf_id.")
+            pdf_id = inserted[0]
+            print(f"[DB] Successfully INSERTED record into 'pdfs' table. New pdf_id is: {pdf_id}")
+            logging.info(f"Inserted PDF '{file_name}' with ID: {pdf_id}")
             return pdf_id
 
     except Error as e:
@@ -422,110 +810,291 @@ def insert_pdf_data(conn, pdf_data, file_name):
         # This will run whether there was an error or not.
         print(f"--- [END] Finished processing insert_pdf_data for: {file_name} ---")
 
+def insert_summary_data(conn, pdf_id, footer):
+    """
+    Stores the footer page's total voter count and detailed summary statistics.
+    """
+    print(f"\n--- [START] Processing insert_summary_data for pdf_id: {pdf_id} ---")
+    try:
+        with conn:
+            cursor = conn.cursor()
+
+            print("\n[DATA] Footer data received:")
+            print(json.dumps(footer, indent=2, ensure_ascii=False))
+            print("-" * 20)
+
+            rows_to_process = footer.get("voter_summary", {}).get("rows") if footer else None
+            if not rows_to_process:
+                print("[WARN] 'voter_summary' or 'rows' key not found in footer data.")
+                return
+
+            total_voters = None
+            print("[INFO] Attempting to extract total voter count from footer.")
+            final_row = rows_to_process[-1]
+            print(f"[DATA] Final row for total count check: {final_row}")
+            if "આ સુધારણા પછી" in final_row.get("description", ""):
+                total_voters = final_row.get("total_count")
+                print(f"[EXTRACT] Successfully extracted total_voters: {total_voters}")
+                cursor.execute("UPDATE pdfs SET total_voters_count = ? WHERE id = ?", (total_voters, pdf_id))
+            else:
+                print("[WARN] Final total description 'આ સુધારણા પછી' not found in the last row.")
+
+            print(f"\n[INFO] Found {len(rows_to_process)} rows to insert into 'summary_stats'.")
+            stat_rows = [
+                (
+                    pdf_id,
+                    row.get('description'),
+                    row.get('male_count'),
+                    row.get('female_count'),
+                    row.get('other_gender_count'),
+                    row.get('total_count')
+                )
+                for row in rows_to_process
+            ]
+            print(f"[DB] Preparing to INSERT into 'summary_stats' with values: {stat_rows}")
+            cursor.executemany("INSERT INTO summary_stats (pdf_id, description, male_count, female_count, other_gender_count, total_count) VALUES (?, ?, ?, ?, ?, ?)", stat_rows)
+            print(f"[DB] Successfully INSERTED {len(stat_rows)} rows into 'summary_stats'.")
+
+    except Error as e:
+        print(f"\n[CRITICAL_ERROR] A database error occurred in insert_summary_data: {e}")
+        logging.error(f"DB Error in insert_summary_data: {e}", exc_info=True)
+    finally:
+        print(f"--- [END] Finished processing insert_summary_data for pdf_id: {pdf_id} ---")
+
+def optimize_database(conn):
+    """
+    Refreshes planner statistics for tables whose contents changed a lot; cheap when nothing did.
+    Run once per ingest job (after all of its PDFs), not per PDF.
+    """
+    try:
+        conn.execute("PRAGMA optimize;")
+    except Error as e:
+        logging.warning(f"PRAGMA optimize failed: {e}")
+
+def delete_pdf_data(conn, pdf_id):
+    """Removes a PDF and (via ON DELETE CASCADE) everything stored for it."""
+    try:
+        with conn:
+            conn.execute("DELETE FROM pdfs WHERE id = ?", (pdf_id,))
+        logging.warning(f"Removed partially stored PDF with ID: {pdf_id}")
+    except Error as e:
+        logging.error(f"DB Error in delete_pdf_data: {e}", exc_info=True)
+
+def gemini_cache_key(image_bytes, prompt):
+    """SHA-256 over model, prompt and image, so a prompt or model change never reuses old answers."""
+    digest = hashlib.sha256(MODEL_NAME.encode())
+    digest.update(prompt.encode())
+    digest.update(image_bytes)
+    return digest.digest()
+
+def get_cached_response(cache_key):
+    """Looks `cache_key` up on the reader connection; runs on DB_READ_EXECUTOR. A failed read is a cache miss."""
+    conn = get_read_connection()
+    if conn is None:
+        return None
+    try:
+        row = conn.execute("SELECT response FROM gemini_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+    except Error as e:
+        logging.warning(f"Could not read the Gemini cache: {e}")
+        return None
+    return row[0] if row else None
+
+def store_cached_response(conn, cache_key, response_text):
+    try:
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO gemini_cache (cache_key, response) VALUES (?, ?)", (cache_key, response_text))
+    except Error as e:
+        logging.warning(f"Could not cache Gemini response: {e}")
+
+def prune_gemini_cache(conn):
+    """Evicts cached responses older than GEMINI_CACHE_MAX_AGE_DAYS; run once per ingest job."""
+    try:
+        with conn:
+            cursor = conn.execute("DELETE FROM gemini_cache WHERE created_at < datetime('now', ?)", (f"-{GEMINI_CACHE_MAX_AGE_DAYS} days",))
+        if cursor.rowcount:
+            logging.info(f"Pruned {cursor.rowcount} expired Gemini cache entries.")
+    except Error as e:
+        logging.warning(f"Could not prune the Gemini cache: {e}")
+
 def insert_sections(conn, pdf_id, header_data):
     if not header_data: return {}
-    section_cache = {}
+    rows = [(pdf_id, value.strip()) for key, value in header_data.items() if key.startswith("location_") and value]
     try:
         with conn:
             cursor = conn.cursor()
-            for key, value in header_data.items():
-                if key.startswith("location_") and value:
-                    section_name = value.strip()
-                    cursor.execute("SELECT id FROM sections WHERE pdf_id = ? AND section_name = ?", (pdf_id, section_name))
-                    existing = cursor.fetchone()
-                    if not existing:
-                        cursor.execute("INSERT INTO sections (pdf_id, section_name) VALUES (?, ?)", (pdf_id, section_name))
-                        section_cache[section_name] = cursor.lastrowid
-                    else:
-                        section_cache[section_name] = existing[0]
-        return section_cache
+            # The unique (pdf_id, section_name) index turns repeated names into no-ops.
+            cursor.executemany("INSERT OR IGNORE INTO sections (pdf_id, section_name) VALUES (?, ?)", rows)
+            cursor.execute("SELECT section_name, id FROM sections WHERE pdf_id = ?", (pdf_id,))
+            return dict(cursor.fetchall())
     except Error as e:
         logging.error(f"DB Error in insert_sections: {e}", exc_info=True)
         return {}
 
-def insert_voter_data(conn, pdf_id, all_voter_data, section_cache):
+def find_existing_voter_ids(cursor, id_card_numbers):
+    """Returns the subset of `id_card_numbers` already stored in the voters table."""
+    existing = set()
+    id_card_numbers = list(id_card_numbers)
+    # Stay well below SQLite's bound-parameter limit for the IN (...) list.
+    for start in range(0, len(id_card_numbers), 900):
+        chunk = id_card_numbers[start:start + 900]
+        placeholders = ",".join("?" * len(chunk))
+        cursor.execute(f"SELECT idc_no FROM voters WHERE idc_no IN ({placeholders})", chunk)
+        existing.update(row[0] for row in cursor.fetchall())
+    return existing
+
+def insert_voter_data(conn, pdf_id, all_voter_data, section_cache, section_lookup_cache=None):
     """
     Inserts voter data using ONLY the PAGE_NO provided by the AI for each record.
-    This version removes all fallback page number logic.
+    All rows of the given pages are collected first and written with multi-row
+    INSERTs (plus executemany() for the tail) inside one explicit transaction. Pass the same
+    `section_lookup_cache` dict across batches to reuse resolved section names.
     """
-    try:
-        voters_inserted = 0
-        sql = "INSERT OR IGNORE INTO voters (section_id, idc_no, VOTER_NAME, RELATIVE_NAME, rln_type, house_no, age, gender, sl_no_in_pdf, box_no_on_page, page_no, statustype, all_text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        
-        # This initial log runs once and is correct
-        pages_to_process = [page[0].get('PAGE_NO', f"Unknown_Index_{i}") for i, page in enumerate(all_voter_data) if page and isinstance(page, list) and page[0]]
-        logging.info(f"Database insertion: Attempting to process data from pages: {pages_to_process}")
+    # This initial log runs once and is correct
+    pages_to_process = [page[0].get('PAGE_NO', f"Unknown_Index_{i}") for i, page in enumerate(all_voter_data) if page and isinstance(page, list) and isinstance(page[0], dict)]
+    logging.info(f"Database insertion: Attempting to process data from pages: {pages_to_process}")
+
+    batch = []
+    # Pages of the same section repeat the same name, so fuzzy-match each name only once.
+    if section_lookup_cache is None:
+        section_lookup_cache = {}
+    for page_index, page_data in enumerate(all_voter_data):
+
+        # These page-level checks are correct
+        if not page_data or not isinstance(page_data, list) or not isinstance(page_data[0], dict) or 'voter' not in page_data[0].get('type', ''):
+            logging.warning(f"SKIPPING non-voter data at page index {page_index + 1}.")
+            continue
 
-        with conn:
-            cursor = conn.cursor()
-            
-            for page_index, page_data in enumerate(all_voter_data):
-                
-                # These page-level checks are correct
-                if not page_data or not isinstance(page_data, list) or 'voter' not in page_data[0].get('type', ''):
-                    logging.warning(f"SKIPPING non-voter data at page index {page_index + 1}.")
-                    continue
-                
-                # We get the page number here ONLY for the page-level log messages. It is NOT used for insertion.
-                page_level_log_no = page_data[0].get('PAGE_NO', f'Unknown_Index_{page_index + 1}')
-                page_section_name = page_data[0].get('PAGE_SECTION_NAME')
-
-                if not page_section_name:
-                    logging.warning(f"SKIPPING PAGE {page_level_log_no}: The 'PAGE_SECTION_NAME' field is missing. Discarding {len(page_data)} records.")
-                    continue
-
-                best_match = max(section_cache.items(), key=lambda item: fuzz.partial_ratio(page_section_name, item[0]), default=(None, None))
-                section_id = best_match[1]
-
-                if not section_id:
-                    logging.warning(f"SKIPPING PAGE {page_level_log_no}: Failed to find a matching section_id for '{page_section_name}'. Discarding {len(page_data)} records.")
-                    continue
-                
-                # This loop now uses the record's own page number for all its logging
-                for record in page_data:
-                    if record.get('IDCARD_NO'):
-                        
-                        # --- THIS IS THE FINAL GUARANTEE ---
-                        # The page number being saved to the database comes ONLY from the record itself.
-                        # The old `current_page_no` variable has been completely removed.
-                        values = (
-                            section_id, 
-                            record.get('IDCARD_NO'), 
-                            record.get('VOTER_NAME'), 
-                            record.get('RELATIVE_NAME'), 
-                            record.get('RLN_TYPE', 'O'), 
-                            record.get('HOUSE_NO'), 
-                            record.get('AGE'), 
-                            normalize_gender(record.get('GENDER')), 
-                            record.get('SL_NO'), 
-                            record.get('BOX_NO_ON_PAGE'), 
-                            record.get('PAGE_NO'),  # <-- DATA FROM AI RECORD
-                            record.get('STATUSTYPE', 'N'), 
-                            record.get('ALL_TXT')
-                        )
-                        cursor.execute(sql, values)
-                        
-                        if cursor.rowcount == 0:
-                            logging.warning(f"DUPLICATE IGNORED on page {record.get('PAGE_NO')}: ID '{record.get('IDCARD_NO')}'")
-                        
-                        voters_inserted += cursor.rowcount
-                    else:
-                        logging.warning(f"SKIPPING RECORD on page {record.get('PAGE_NO')}: Missing IDCARD_NO. (Name: '{record.get('VOTER_NAME')}')")
-
-            logging.info(f"Committed {voters_inserted} new voter records.")
+        # We get the page number here ONLY for the page-level log messages. It is NOT used for insertion.
+        page_level_log_no = page_data[0].get('PAGE_NO', f'Unknown_Index_{page_index + 1}')
+        page_section_name = page_data[0].get('PAGE_SECTION_NAME')
+
+        if not page_section_name:
+            logging.warning(f"SKIPPING PAGE {page_level_log_no}: The 'PAGE_SECTION_NAME' field is missing. Discarding {len(page_data)} records.")
+            continue
+
+        if page_section_name in section_lookup_cache:
+            section_id = section_lookup_cache[page_section_name]
+        else:
+            best_match = process.extractOne(page_section_name, list(section_cache), scorer=fuzz.partial_ratio, score_cutoff=SECTION_MATCH_SCORE_CUTOFF)
+            section_id = section_lookup_cache[page_section_name] = section_cache[best_match[0]] if best_match else None
 
+        if not section_id:
+            logging.warning(f"SKIPPING PAGE {page_level_log_no}: Failed to find a matching section_id for '{page_section_name}'. Discarding {len(page_data)} records.")
+            continue
+
+        for record in page_data:
+            if not isinstance(record, dict):
+                logging.warning(f"SKIPPING non-object record on page {page_level_log_no}: {record!r}")
+                continue
+            if not record.get('IDCARD_NO'):
+                logging.warning(f"SKIPPING RECORD on page {record.get('PAGE_NO')}: Missing IDCARD_NO. (Name: '{record.get('VOTER_NAME')}')")
+                continue
+            # The page number being saved to the database comes ONLY from the record itself.
+            batch.append((
+                section_id,
+                record.get('IDCARD_NO'),
+                record.get('VOTER_NAME'),
+                record.get('RELATIVE_NAME'),
+                record.get('RLN_TYPE', 'O'),
+                record.get('HOUSE_NO'),
+                record.get('AGE'),
+                normalize_gender(record.get('GENDER')),
+                record.get('SL_NO'),
+                record.get('BOX_NO_ON_PAGE'),
+                record.get('PAGE_NO'),  # <-- DATA FROM AI RECORD
+                record.get('STATUSTYPE', 'N'),
+                age_group(record.get('AGE'))
+            ))
+
+    if not batch:
+        logging.info("Committed 0 new voter records.")
+        return
+
+    try:
+        cursor = conn.cursor()
+        # IMMEDIATE takes the write lock before the duplicate-check read, so a concurrent
+        # writer makes us wait on the busy timeout instead of failing the read->write upgrade.
+        cursor.execute("BEGIN IMMEDIATE")
+        # Identify duplicates up front; rowcount is not reliable per row with executemany.
+        existing_ids = find_existing_voter_ids(cursor, {row[1] for row in batch})
+        seen_ids = set()
+        for row in batch:
+            if row[1] in existing_ids or row[1] in seen_ids:
+                logging.warning(f"DUPLICATE IGNORED on page {row[10]}: ID '{row[1]}'")
+            seen_ids.add(row[1])
+        # Full chunks go through the multi-row statement, so SQLite steps it once per chunk; the tail uses executemany.
+        full_chunks_end = len(batch) - len(batch) % VOTER_ROWS_PER_STATEMENT
+        for start in range(0, full_chunks_end, VOTER_ROWS_PER_STATEMENT):
+            cursor.execute(VOTER_MULTI_INSERT_SQL, list(itertools.chain.from_iterable(batch[start:start + VOTER_ROWS_PER_STATEMENT])))
+        cursor.executemany(VOTER_INSERT_SQL, batch[full_chunks_end:])
+        conn.commit()
+        logging.info(f"Committed {len(seen_ids - existing_ids)} new voter records.")
     except Exception:
+        conn.rollback()
         logging.error("!!!!!! A CRITICAL UNEXPECTED ERROR OCCURRED IN insert_voter_data !!!!!!", exc_info=True)
+
 # --- 6. Main Pipeline Function ---
+async def await_page_data(task, prompt_type, page_index):
+    """Awaits a page task and returns its parsed data, or None if the page failed."""
+    if task is None:
+        return None
+    try:
+        res = await task
+    except Exception as e:
+        res = e
+    if isinstance(res, Exception) or not res:
+        logging.error(f"Failed to get result for page {page_index + 1}: {res}")
+        return None
+    parsed = parse_gemini_response(res, prompt_type, page_index)
+    # --- THIS IS THE FIX ---
+    # If this is a voter page, loop through every record and add the correct page and box number.
+    if prompt_type == "voter_list_page" and isinstance(parsed, list):
+        correct_page_no = page_index + 1
+        for box_no, record in enumerate(parsed, start=1):
+            if isinstance(record, dict):
+                record['PAGE_NO'] = correct_page_no
+                record['BOX_NO_ON_PAGE'] = box_no
+        logging.info(f"Page {correct_page_no}: Parsed {len(parsed)} voter records.")
+    return parsed
+
+async def store_voter_pages_as_completed(db_connection, pdf_id, voter_tasks, section_cache):
+    """
+    Parses voter pages in completion order and writes them in batches of
+    VOTER_INSERT_BATCH_SIZE rows, so inserts overlap with pages still at Gemini.
+    Consumed tasks are popped from voter_tasks so their raw responses can be freed.
+    Returns the number of records passed to the database.
+    """
+    section_lookup_cache = {}
+    pending_pages, pending_rows, total_records = [], 0, 0
+    remaining = set(voter_tasks)
+    while remaining:
+        done, remaining = await asyncio.wait(remaining, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            page_data = await await_page_data(task, "voter_list_page", voter_tasks.pop(task))
+            if page_data:
+                pending_pages.append(page_data)
+                pending_rows += len(page_data)
+        if pending_rows >= VOTER_INSERT_BATCH_SIZE or (not remaining and pending_pages):
+            await run_db_write(insert_voter_data, db_connection, pdf_id, pending_pages, section_cache, section_lookup_cache)
+            total_records += pending_rows
+            pending_pages, pending_rows = [], 0
+    return total_records
+
 async def process_single_pdf_and_store_data_async(pdf_path, status_callback, db_connection):
     """
-    Processes a single PDF file, and MANUALLY adds the correct page number
-    to each voter record after parsing.
+    Processes a single PDF file. The header page is stored first; voter pages
+    are then parsed and inserted as they come back from Gemini, and the footer
+    summary is added last.
     """
     pdf_file_name = os.path.basename(pdf_path)
     logging.info(f"Starting processing for {pdf_file_name}...")
     status_callback("processing", f"Opening {pdf_file_name}...")
 
+    if await run_db_write(pdf_exists, db_connection, pdf_file_name):
+        logging.warning(f"PDF record for {pdf_file_name} not inserted (may already exist).")
+        status_callback("processing", f"{pdf_file_name} already exists in database. Skipped.")
+        return
+
     try:
         with fitz.open(pdf_path) as doc: num_pages = len(doc)
     except Exception as e:
@@ -534,67 +1103,53 @@ async def process_single_pdf_and_store_data_async(pdf_path, status_callback, db_
         return
 
     page_prompts = ["header_metadata" if i == 0 else "footer_summary" if i == num_pages - 1 else "voter_list_page" for i in range(num_pages)]
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-    tasks = []
-    
-    for i in range(num_pages):
-        if i == 1: # Skip page 2
-            tasks.append(_do_nothing())
-            continue
-        page_image = convert_pdf_page_to_image(pdf_path, i)
-        if not page_image: continue
-        
-        prompt_type = page_prompts[i]
-        task = process_voter_page_in_chunks_async(semaphore, page_image, VOTER_LIST_PAGE_PROMPT, i) if prompt_type == "voter_list_page" else process_image_with_gemini_async(semaphore, page_image, PROMPT_MAPPING.get(prompt_type), i + 1)
-        tasks.append(task)
+    # Resolve the prompt text, render DPI and chunking choice once per page instead of inside the dispatch loop.
+    prompts = [PROMPT_MAPPING[prompt_type] for prompt_type in page_prompts]
+    render_dpis = [RENDER_DPI_BY_PROMPT[prompt_type] for prompt_type in page_prompts]
+    is_voter_page = [prompt_type == "voter_list_page" for prompt_type in page_prompts]
+    semaphore = get_gemini_semaphore()
+    loop = asyncio.get_running_loop()
+    task_page_indices = [i for i in range(num_pages) if i not in SKIPPED_PAGE_INDICES]
+    page_tasks = {i: loop.create_future() for i in task_page_indices}
+
+    # Render -> Gemini pipeline: pages rasterize on the pool while earlier pages are
+    # already at Gemini, with the bounded queue capping how many rendered pages wait.
+    # Voter pages are rendered straight into top/bottom halves for chunked processing.
+    render_queue = asyncio.Queue(maxsize=MAX_CONCURRENT_REQUESTS * 2)
+    stage_tasks = [asyncio.ensure_future(render_pages_async(pdf_path, task_page_indices, render_dpis, is_voter_page, render_queue, page_tasks))]
+    stage_tasks += [asyncio.ensure_future(gemini_worker_async(semaphore, render_queue, prompts, page_tasks, db_connection)) for _ in range(MAX_CONCURRENT_REQUESTS)]
 
     status_callback("processing", f"Extracting data from {num_pages} pages...")
-    results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    all_parsed_data = {}
-    for i, res in enumerate(results):
-        if isinstance(res, Exception) or not res:
-            logging.error(f"Failed to get result for page {i + 1}: {res}")
-            continue
-            
-        prompt_type = page_prompts[i]
-        parsed = parse_gemini_response(res, prompt_type, i)
-        
-        if parsed:
-            # --- THIS IS THE FIX ---
-            # If this is a voter page, loop through every record and add the correct page number.
-            if prompt_type == "voter_list_page" and isinstance(parsed, list):
-                correct_page_no = i + 1
-                for record in parsed:
-                    if isinstance(record, dict):
-                        record['PAGE_NO'] = correct_page_no
-                logging.info(f"Page {correct_page_no}: Parsed {len(parsed)} voter records.")
-            
-            all_parsed_data[i] = parsed
-            
-    for i, data in all_parsed_data.items():
-        if page_prompts[i] == "voter_list_page" and isinstance(data, list):
-            for j, record in enumerate(data):
-                if isinstance(record, dict): record['BOX_NO_ON_PAGE'] = j + 1
-                    
-    status_callback("processing", f"Saving extracted data for {pdf_file_name}...")
-    header_data = all_parsed_data.get(0)
-    footer_data = all_parsed_data.get(num_pages - 1)
-    voter_pages_data = [data for i, data in all_parsed_data.items() if page_prompts[i] == "voter_list_page" and data]
-    
-    if not header_data:
-        logging.error(f"Missing header data for '{pdf_file_name}'. Cannot proceed.")
-        status_callback("error", f"Missing header data for {pdf_file_name}")
-        return
-        
-    pdf_id = insert_pdf_data(db_connection, {'header_metadata': header_data, 'footer_summary': footer_data}, pdf_file_name)
-    if pdf_id is None:
-        logging.warning(f"PDF record for {pdf_file_name} not inserted (may already exist).")
-        status_callback("processing", f"{pdf_file_name} already exists in database. Skipped.")
-        return
-        
-    logging.info(f"VERIFICATION: Passing a total of {sum(len(page) for page in voter_pages_data)} records to the database function.")
-    section_cache = insert_sections(db_connection, pdf_id, header_data)
-    insert_voter_data(db_connection, pdf_id, voter_pages_data, section_cache)
+    header_task = page_tasks.get(0)
+    footer_task = page_tasks.get(num_pages - 1) if num_pages > 1 else None
+    voter_tasks = {task: i for i, task in page_tasks.items() if is_voter_page[i]}
+
+    try:
+        header_data = await await_page_data(header_task, "header_metadata", 0)
+        if not header_data:
+            logging.error(f"Missing header data for '{pdf_file_name}'. Cannot proceed.")
+            status_callback("error", f"Missing header data for {pdf_file_name}")
+            return
+
+        pdf_id = await run_db_write(insert_pdf_data, db_connection, header_data, pdf_file_name)
+        if pdf_id is None:
+            logging.warning(f"PDF record for {pdf_file_name} not inserted (may already exist).")
+            status_callback("processing", f"{pdf_file_name} already exists in database. Skipped.")
+            return
+
+        try:
+            section_cache = await run_db_write(insert_sections, db_connection, pdf_id, header_data)
+            status_callback("processing", f"Saving extracted data for {pdf_file_name} as pages complete...")
+            total_records = await store_voter_pages_as_completed(db_connection, pdf_id, voter_tasks, section_cache)
+            logging.info(f"VERIFICATION: Passed a total of {total_records} records to the database function.")
+            footer_data = await await_page_data(footer_task, "footer_summary", num_pages - 1)
+            await run_db_write(insert_summary_data, db_connection, pdf_id, footer_data)
+        except BaseException:
+            # Don't leave a half-stored PDF behind; a re-upload would be skipped as a duplicate.
+            await run_db_write(delete_pdf_data, db_connection, pdf_id)
+            raise
+    finally:
+        for task in [*stage_tasks, *page_tasks.values(), *voter_tasks]:
+            task.cancel()
         
-    logging.info(f"--- Finished processing {pdf_file_name} ---")
\ No newline at end of file
+    logging.info(f"--- Finished processing {pdf_file_name} ---")
@@ -1,26 +1,45 @@
 print("--- !!! WEBAPP.PY IS BEING LOADED BY PYTHON !!! ---")
 import os
 import uuid
+import time
+import functools
 import threading
 import webbrowser
 import logging
 import asyncio
 import io
+import itertools
+import csv
 import zipfile
+import shutil
 import sqlite3
-import pandas as pd
+import orjson
 import sys # +++ ADD THIS IMPORT
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request
 from werkzeug.utils import secure_filename
 from waitress import serve
 
 # Import your entire processing logic from the other file
 import pipeline_processor
 
+# Optional: enables /download_csv?format=parquet when installed.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
 # --- Windows Event Loop Policy (Crucial for stability) ---
 # +++ ADD THIS BLOCK +++
 if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+else:
+    # uvloop gives cheaper task wake-ups for the many concurrent Gemini requests.
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
 
 # --- Basic Configuration & Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -28,11 +47,39 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 # --- Flask App Initialization ---
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploaded_pdfs'
+# Requests above this are rejected with 413 before the body is parsed.
+app.config['MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024
+UPLOAD_COPY_BUFFER_SIZE = 1 << 20  # 1 MiB chunks when writing uploads to disk
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
-# --- Global Job Store (Thread-Safe) ---
-JOBS = {}
-JOBS_LOCK = threading.Lock()
+# sqlite3 releases the GIL while a query runs, so extra waitress threads keep /status
+# polling and the dashboard responsive during exports and analytics queries (default is 4).
+WAITRESS_THREADS = 16
+CSV_EXPORT_FETCH_SIZE = 5000  # rows per fetchmany() while streaming /download_csv
+
+# --- Dashboard SQL ---
+# Module-level constants: the routes pass the identical string every time, which is what
+# sqlite3's per-connection statement cache keys on, so each connection prepares them once.
+ALL_PDFS_SQL = "SELECT id, file_name FROM pdfs ORDER BY id"
+SECTIONS_FOR_PDF_SQL = "SELECT id, section_name FROM sections WHERE pdf_id = ? ORDER BY section_name"
+# Both charts in one statement: rows are tagged 'age' or 'gender' and split in Python.
+SECTION_ANALYTICS_SQL = "SELECT 'gender', gender, COUNT(*) FROM voters WHERE section_id = ? GROUP BY gender UNION ALL SELECT 'age', age_group, COUNT(*) FROM voters WHERE section_id = ? AND age_group IS NOT NULL GROUP BY age_group ORDER BY 1, 2"
+PDF_ANALYTICS_SQL = "WITH pdf_voters AS (SELECT v.gender, v.age_group FROM voters v JOIN sections s ON v.section_id = s.id WHERE s.pdf_id = ?) SELECT 'gender', gender, COUNT(*) FROM pdf_voters GROUP BY gender UNION ALL SELECT 'age', age_group, COUNT(*) FROM pdf_voters WHERE age_group IS NOT NULL GROUP BY age_group ORDER BY 1, 2"
+DATA_VERSION_SQL = "SELECT (SELECT version FROM data_version), (SELECT MAX(id) FROM pdfs), (SELECT COUNT(*) FROM pdfs), (SELECT MAX(id) FROM sections), (SELECT MAX(id) FROM voters)"
+
+# --- Job Store (SQLite `jobs` table) ---
+# Status lives in the database, so it survives restarts and /status is one primary-key lookup.
+def set_job_status(job_id, status, message):
+    """Upserts a job's status using the calling thread's own connection."""
+    conn = get_db_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO jobs (id, status, message, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET status = excluded.status, message = excluded.message, updated_at = excluded.updated_at",
+            (job_id, status, message, time.time()))
+
+def get_job_status(job_id):
+    row = get_db_connection().execute("SELECT status, message FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return {"status": row[0], "message": row[1]} if row else None
 
 # +++ STEP 1: ADD THE BACKGROUND TASK MANAGER CLASS +++
 class BackgroundTaskManager:
@@ -73,13 +120,31 @@ async def process_all_pdfs_job(job_id, pdf_paths):
     """An async function that orchestrates the processing of all PDFs for a job."""
     logging.info(f"Job {job_id}: Starting async processing for {len(pdf_paths)} files.")
 
+    loop = asyncio.get_running_loop()
+
+    def store_status(status, message):
+        """Runs on the pipeline's DB writer thread; a failed write is logged, not raised into the pipeline."""
+        try:
+            set_job_status(job_id, status, message)
+        except sqlite3.Error as e:
+            logging.warning(f"Job {job_id}: could not store status update: {e}")
+
+    def log_status_write_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error(f"Job {job_id}: status update failed", exc_info=future.exception())
+
     def update_status_for_job(status, message):
-        """A helper to update the global JOBS dictionary safely."""
-        with JOBS_LOCK:
-            JOBS[job_id]['status'] = status
-            JOBS[job_id]['message'] = message
+        """
+        A helper to record the job's status. The write is queued on the DB writer thread
+        (in order, behind the pipeline's inserts) so its commit never blocks the event loop.
+        Returns the write's future, so the job can wait for its final status to be stored.
+        """
+        future = loop.run_in_executor(pipeline_processor.DB_WRITE_EXECUTOR, store_status, status, message)
+        future.add_done_callback(log_status_write_error)
         logging.info(f"Job {job_id} status: {status} - {message}")
+        return future
 
+    conn = None
     try:
         db_path = "voter_data.db"
         conn = pipeline_processor.create_connection(db_path)
@@ -88,26 +153,106 @@ async def process_all_pdfs_job(job_id, pdf_paths):
         # No need to create tables here, it's done on startup
 
         total_pdfs = len(pdf_paths)
-        for i, pdf_path in enumerate(pdf_paths):
-            pdf_name = os.path.basename(pdf_path)
-            update_status_for_job("processing", f"Processing PDF {i+1}/{total_pdfs}: {pdf_name}")
-            
-            # Await the processing function directly
-            await pipeline_processor.process_single_pdf_and_store_data_async(pdf_path, update_status_for_job, conn)
-        
-        conn.close()
-        update_status_for_job("complete", f"Successfully processed {total_pdfs} files.")
+        # Several PDFs run at once so one file's rendering and DB writes overlap another's
+        # Gemini waits; the pipeline's shared semaphore and rate limiters still cap total API usage.
+        pdf_semaphore = asyncio.Semaphore(pipeline_processor.MAX_CONCURRENT_PDFS)
+
+        async def process_one_pdf(i, pdf_path):
+            async with pdf_semaphore:
+                pdf_name = os.path.basename(pdf_path)
+                update_status_for_job("processing", f"Processing PDF {i+1}/{total_pdfs}: {pdf_name}")
+                await pipeline_processor.process_single_pdf_and_store_data_async(pdf_path, update_status_for_job, conn)
+
+        # return_exceptions: a failing PDF must not leave the others running while their files are removed below.
+        results = await asyncio.gather(*(process_one_pdf(i, pdf_path) for i, pdf_path in enumerate(pdf_paths)), return_exceptions=True)
+        await pipeline_processor.run_db_write(pipeline_processor.prune_gemini_cache, conn)
+        # One ANALYZE pass over the whole job's inserts, so the dashboard queries plan with fresh stats.
+        await pipeline_processor.run_db_write(pipeline_processor.optimize_database, conn)
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            raise failures[0]
+        # wait() rather than await: a failed status write is logged by its callback and must not turn the job into an error.
+        await asyncio.wait([update_status_for_job("complete", f"Successfully processed {total_pdfs} files.")])
 
     except Exception as e:
         logging.error(f"Job {job_id}: Error in background task", exc_info=True)
-        update_status_for_job("error", f"An error occurred: {e}")
+        await asyncio.wait([update_status_for_job("error", f"An error occurred: {e}")])
     finally:
-        # Clean up the uploaded files
-        for pdf_path in pdf_paths:
-            try:
-                os.remove(pdf_path)
-            except OSError as e:
-                logging.warning(f"Could not remove temp file {pdf_path}: {e}")
+        if conn is not None:
+            # Closed on the writer thread, behind any DB call still queued there.
+            await pipeline_processor.run_db_write(conn.close)
+        # Clean up the uploaded files on the default thread pool, all at once, so the unlinks don't block the loop.
+        removals = await asyncio.gather(*(loop.run_in_executor(None, os.remove, pdf_path) for pdf_path in pdf_paths), return_exceptions=True)
+        for pdf_path, result in zip(pdf_paths, removals):
+            if isinstance(result, OSError):
+                logging.warning(f"Could not remove temp file {pdf_path}: {result}")
+
+
+# --- Per-Thread Database Connections ---
+_DB_LOCAL = threading.local()
+
+def get_db_connection():
+    """
+    Returns this thread's long-lived connection, opened on first use with the
+    pipeline's PRAGMAs (WAL, mmap, 64 MiB cache) so page caches stay warm.
+    """
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None:
+        conn = pipeline_processor.create_connection("voter_data.db")
+        if conn is None:
+            raise sqlite3.Error("Failed to create database connection.")
+        _DB_LOCAL.conn = conn
+    return conn
+
+# --- Response & Query Result Helpers ---
+def json_response(data):
+    """Serializes `data` with orjson (C, UTF-8 straight to bytes) instead of Flask's stdlib-json jsonify."""
+    return Response(orjson.dumps(data), mimetype='application/json')
+
+def rows_to_records(cursor):
+    """Returns the cursor's rows as a list of {column: value} dicts."""
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def rows_to_chart_data(rows):
+    """Splits (label, count) rows into the {labels, data} shape the dashboard charts expect."""
+    return {"labels": [row[0] for row in rows], "data": [row[1] for row in rows]}
+
+def data_version_etag(conn):
+    """
+    Cheap version token for everything the dashboard reads: each lookup is a rowid
+    MAX, a count of the small pdfs table or the one-row data_version counter. Inserts
+    raise a MAX(id); deletes bump data_version (via trigger), so a reused rowid after
+    a rolled-back PDF can never reproduce an earlier token.
+    """
+    row = conn.execute(DATA_VERSION_SQL).fetchone()
+    return "-".join(str(value or 0) for value in row)
+
+def with_data_etag(view):
+    """Answers 304 Not Modified when the client already has the current data version; tags 200 responses with it."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            etag = data_version_etag(get_db_connection())
+        except sqlite3.Error:
+            return view(*args, **kwargs)  # let the view report the DB error in its usual JSON shape
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'  # always revalidate; the 304 is the cheap path
+        return response
+    return wrapper
+
+def analytics_rows_to_response(rows):
+    """Splits (metric, label, count) rows of a combined analytics query into the dashboard's chart payload."""
+    charts = {"gender": [], "age": []}
+    for metric, label, count in rows:
+        charts[metric].append((label, count))
+    return {"gender_data": rows_to_chart_data(charts["gender"]), "age_data": rows_to_chart_data(charts["age"])}
 
 
 # --- Flask Web Routes ---
@@ -115,129 +260,203 @@ async def process_all_pdfs_job(job_id, pdf_paths):
 def home():
     return render_template('index.html')
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    # The upload page reads error messages from JSON.
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return json_response({"error": f"Upload too large. The limit is {limit_mb} MB per request."}), 413
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
     # --- STEP 4: UPDATE the upload route ---
     files = request.files.getlist('file')
     if not files or files[0].filename == '':
-        return jsonify({"error": "No files selected"}), 400
+        return json_response({"error": "No files selected"}), 400
 
     saved_paths = []
     for f in files:
         if f and f.filename.lower().endswith('.pdf'):
             path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(f.filename))
-            f.save(path)
+            with open(path, 'wb') as out:
+                shutil.copyfileobj(f.stream, out, length=UPLOAD_COPY_BUFFER_SIZE)
             saved_paths.append(path)
 
     if not saved_paths:
-        return jsonify({"error": "No valid PDF files uploaded"}), 400
+        return json_response({"error": "No valid PDF files uploaded"}), 400
 
     job_id = str(uuid.uuid4())
-    with JOBS_LOCK:
-        JOBS[job_id] = {"status": "queued", "message": "Files queued for processing..."}
+    set_job_status(job_id, "queued", "Files queued for processing...")
 
     # Instead of creating a thread, create a coroutine and submit it
     job_coro = process_all_pdfs_job(job_id, saved_paths)
     task_manager.submit_job(job_coro)
     
-    return jsonify({"job_id": job_id})
+    return json_response({"job_id": job_id})
 
 # ... All of your other routes (/status, /download_csv, /dashboard, /api/...) remain exactly the same ...
 @app.route('/status/<job_id>')
 def get_status(job_id):
-    with JOBS_LOCK:
-        job = JOBS.get(job_id, {"status": "error", "message": "Job ID not found."})
-        return jsonify(job)
+    job = get_job_status(job_id) or {"status": "error", "message": "Job ID not found."}
+    return json_response(job)
+
+class ZipStreamSink(io.RawIOBase):
+    """Write-only, unseekable sink for ZipFile; collects output until the generator yields it."""
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def generate_csv_export_zip(conn, tables):
+    """
+    Yields a ZIP of one CSV per table while it is being written, CSV_EXPORT_FETCH_SIZE
+    rows at a time, so memory stays flat however large the tables are.
+    """
+    sink = ZipStreamSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for table_name in tables:
+            # force_zip64: the entry size isn't known up front, and a large voters table can pass 2 GiB.
+            with zf.open(f"{table_name}.csv", 'w', force_zip64=True) as raw, io.TextIOWrapper(raw, encoding='utf-8', newline='') as text:
+                cursor = conn.execute(f"SELECT * FROM {table_name}")
+                writer = csv.writer(text)
+                writer.writerow([column[0] for column in cursor.description])
+                for rows in iter(lambda: cursor.fetchmany(CSV_EXPORT_FETCH_SIZE), []):
+                    writer.writerows(rows)
+                    yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+def integer_only_columns(conn, table_name, integer_columns):
+    """
+    Returns the declared-INTEGER columns whose stored values really are all integers.
+    SQLite keeps whatever it is given (e.g. Gujarati-numeral ages stay text), so the
+    others are exported as strings rather than losing those values.
+    """
+    if not integer_columns:
+        return set()
+    checks = ", ".join(f"COALESCE(MAX(typeof(`{name}`) NOT IN ('integer', 'null')), 0)" for name in integer_columns)
+    has_other_types = conn.execute(f"SELECT {checks} FROM {table_name}").fetchone()
+    return {name for name, mixed in zip(integer_columns, has_other_types) if not mixed}
+
+def generate_parquet_export_zip(conn, tables):
+    """
+    Yields a ZIP of one zstd-compressed Parquet file per table while it is being written.
+    Parquet is written front to back (the footer goes last, nothing seeks), so each file
+    streams straight into its ZIP entry, one CSV_EXPORT_FETCH_SIZE-row group at a time.
+    """
+    sink = ZipStreamSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:  # Parquet pages are already compressed
+        for table_name in tables:
+            conn.execute("BEGIN")  # one snapshot for the type check and the rows it describes
+            try:
+                columns = [(row[1], row[2].upper()) for row in conn.execute(f"PRAGMA table_info({table_name})")]
+                if not columns:
+                    raise sqlite3.OperationalError(f"no such table: {table_name}")
+                int64_columns = integer_only_columns(conn, table_name, [name for name, declared in columns if declared == "INTEGER"])
+                schema = pa.schema([(name, pa.int64() if name in int64_columns else pa.string()) for name, _ in columns])
+                select_list = ", ".join(f"`{name}`" if name in int64_columns else f"CAST(`{name}` AS TEXT)" for name, _ in columns)
+                # force_zip64: as with the CSV entries, the size isn't known up front.
+                with zf.open(f"{table_name}.parquet", 'w', force_zip64=True) as raw, \
+                        pq.ParquetWriter(pa.PythonFile(raw, mode='w'), schema, compression="zstd") as parquet_writer:
+                    cursor = conn.execute(f"SELECT {select_list} FROM {table_name}")
+                    for rows in iter(lambda: cursor.fetchmany(CSV_EXPORT_FETCH_SIZE), []):
+                        arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)]
+                        parquet_writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                        yield sink.take()
+            finally:
+                conn.commit()
+            yield sink.take()
+    yield sink.take()
+
+def log_export_errors(chunks, export_label):
+    """
+    Passes export chunks through, logging any failure. Once the first chunk has been
+    sent the status can no longer change, so the client just gets a truncated ZIP.
+    """
+    try:
+        yield from chunks
+    except Exception:
+        logging.error(f"{export_label} export failed.", exc_info=True)
+        raise
 
 @app.route('/download_csv')
 def download_csv():
-    # This route remains the same
-    db_path = "voter_data.db"
-    if not os.path.exists(db_path):
-        return jsonify({"error": "Database file not found. Please process at least one PDF first."}), 404
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'parquet'):
+        return json_response({"error": f"Unsupported export format '{export_format}'. Use 'csv' or 'parquet'."}), 400
+    if export_format == 'parquet' and pa is None:
+        return json_response({"error": "Parquet export requires pyarrow to be installed."}), 501
+    export_label = 'Parquet' if export_format == 'parquet' else 'CSV'
     try:
-        conn = sqlite3.connect(db_path)
+        conn = get_db_connection()
         tables = ['pdfs', 'sections', 'voters', 'summary_stats']
-        memory_file = io.BytesIO()
-        with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for table_name in tables:
-                df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-                csv_data = df.to_csv(index=False)
-                zf.writestr(f"{table_name}.csv", csv_data)
-        conn.close()
-        memory_file.seek(0)
-        return send_file(memory_file, download_name='voter_data_export.zip', as_attachment=True, mimetype='application/zip')
+        if export_format == 'parquet':
+            generate_export, download_name = generate_parquet_export_zip, 'voter_data_export_parquet.zip'
+        else:
+            generate_export, download_name = generate_csv_export_zip, 'voter_data_export.zip'
+        # The archive is produced while it downloads, so nothing is buffered server-side.
+        chunks = log_export_errors(generate_export(conn, tables), export_label)
+        # Run the first query before any headers go out, so e.g. a missing table still gets the JSON 500.
+        first_chunk = next(chunks)
+        return Response(itertools.chain([first_chunk], chunks), mimetype='application/zip',
+                        headers={"Content-Disposition": f"attachment; filename={download_name}"})
     except Exception as e:
-        return jsonify({"error": f"Failed to generate CSV export: {e}"}), 500
+        return json_response({"error": f"Failed to generate {export_label} export: {e}"}), 500
 
 @app.route('/dashboard')
 def dashboard():
     return render_template('dashboard.html')
 
 @app.route('/api/pdfs')
+@with_data_etag
 def get_all_pdfs():
-    # This route remains the same
-    db_path = "voter_data.db"
-    if not os.path.exists(db_path):
-        return jsonify({"error": "Database not found."}), 404
     try:
-        conn = sqlite3.connect(db_path)
-        df = pd.read_sql_query("SELECT id, file_name FROM pdfs ORDER BY id", conn)
-        conn.close()
-        return jsonify(df.to_dict(orient='records'))
+        conn = get_db_connection()
+        records = rows_to_records(conn.execute(ALL_PDFS_SQL))
+        return json_response(records)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}), 500
 
 @app.route('/api/sections/<int:pdf_id>')
+@with_data_etag
 def get_sections_for_pdf(pdf_id):
-    # This route remains the same
-    db_path = "voter_data.db"
-    if not os.path.exists(db_path):
-        return jsonify({"error": "Database not found."}), 404
     try:
-        conn = sqlite3.connect(db_path)
-        query = "SELECT id, section_name FROM sections WHERE pdf_id = ? ORDER BY section_name"
-        df = pd.read_sql_query(query, conn, params=(pdf_id,))
-        conn.close()
-        return jsonify(df.to_dict(orient='records'))
+        conn = get_db_connection()
+        records = rows_to_records(conn.execute(SECTIONS_FOR_PDF_SQL, (pdf_id,)))
+        return json_response(records)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}), 500
 
 @app.route('/api/analytics/section/<int:section_id>')
+@with_data_etag
 def get_analytics_for_section(section_id):
-    # This route remains the same
-    db_path = "voter_data.db"
-    if not os.path.exists(db_path):
-        return jsonify({"error": "Database not found."}), 404
     try:
-        conn = sqlite3.connect(db_path)
-        gender_query = "SELECT gender, COUNT(*) as count FROM voters WHERE section_id = ? GROUP BY gender"
-        gender_df = pd.read_sql_query(gender_query, conn, params=(section_id,))
-        age_query = "SELECT CASE WHEN age BETWEEN 18 AND 29 THEN '18-29' WHEN age BETWEEN 30 AND 39 THEN '30-39' WHEN age BETWEEN 40 AND 49 THEN '40-49' WHEN age BETWEEN 50 AND 59 THEN '50-59' ELSE '60+' END as age_group, COUNT(*) as count FROM voters WHERE section_id = ? AND age IS NOT NULL GROUP BY age_group ORDER BY age_group"
-        age_df = pd.read_sql_query(age_query, conn, params=(section_id,))
-        conn.close()
-        response_data = {"gender_data": {"labels": gender_df['gender'].tolist(), "data": gender_df['count'].tolist()}, "age_data": {"labels": age_df['age_group'].tolist(), "data": age_df['count'].tolist()}}
-        return jsonify(response_data)
+        conn = get_db_connection()
+        rows = conn.execute(SECTION_ANALYTICS_SQL, (section_id, section_id)).fetchall()
+        response_data = analytics_rows_to_response(rows)
+        return json_response(response_data)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}), 500
 
 @app.route('/api/analytics/pdf/<int:pdf_id>')
+@with_data_etag
 def get_analytics_for_pdf(pdf_id):
-    # This route remains the same
-    db_path = "voter_data.db"
-    if not os.path.exists(db_path):
-        return jsonify({"error": "Database not found."}), 404
     try:
-        conn = sqlite3.connect(db_path)
-        gender_query = "SELECT v.gender, COUNT(*) as count FROM voters v JOIN sections s ON v.section_id = s.id WHERE s.pdf_id = ? GROUP BY v.gender"
-        gender_df = pd.read_sql_query(gender_query, conn, params=(pdf_id,))
-        age_query = "SELECT CASE WHEN age BETWEEN 18 AND 29 THEN '18-29' WHEN age BETWEEN 30 AND 39 THEN '30-39' WHEN age BETWEEN 40 AND 49 THEN '40-49' WHEN age BETWEEN 50 AND 59 THEN '60+' ELSE '60+' END as age_group, COUNT(*) as count FROM voters v JOIN sections s ON v.section_id = s.id WHERE s.pdf_id = ? AND age IS NOT NULL GROUP BY age_group ORDER BY age_group"
-        age_df = pd.read_sql_query(age_query, conn, params=(pdf_id,))
-        conn.close()
-        response_data = {"gender_data": {"labels": gender_df['gender'].tolist(), "data": gender_df['count'].tolist()}, "age_data": {"labels": age_df['age_group'].tolist(), "data": age_df['count'].tolist()}}
-        return jsonify(response_data)
+        conn = get_db_connection()
+        rows = conn.execute(PDF_ANALYTICS_SQL, (pdf_id,)).fetchall()
+        response_data = analytics_rows_to_response(rows)
+        return json_response(response_data)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}), 500
 
 
 # --- Main Entry Point ---
@@ -248,6 +467,9 @@ if __name__ == '__main__':
     conn = pipeline_processor.create_connection(db_path)
     if conn is not None:
         pipeline_processor.create_tables(conn)
+        # Jobs that were running when the server stopped will never finish; don't leave them "processing".
+        with conn:
+            conn.execute("UPDATE jobs SET status = 'error', message = 'Interrupted by a server restart.' WHERE status IN ('queued', 'processing')")
         conn.close()
         logging.info("Database is ready.")
     else:
@@ -258,4 +480,4 @@ if __name__ == '__main__':
     task_manager.start()
 
     webbrowser.open_new("http://127.0.0.1:8080")
-    serve(app, host="127.0.0.1", port=8080)
\ No newline at end of file
+    serve(app, host="127.0.0.1", port=8080, threads=WAITRESS_THREADS)
\ No newline at end of file